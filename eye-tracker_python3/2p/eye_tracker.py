@@ -0,0 +1,498 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from eye_tracker_helpers import *
+from result_handling import *
+
+__version__ = '1.1.3'
+
+
+def trackVideo(video, thresh, roi=None, backend='contours', background=None, start=None, stop=None, prefetch=0,
+               checkpoint=None, checkpoint_every=1000, tolerant=False, head_fixed=False,
+               eye_windows=False):
+    """
+    Runs frameData on every frame of a video
+    :param video: Video class object (video_handling)
+    :param thresh: threshold used to find eyes and swimbladder
+    :param roi: crop each frame to ROI (if None then video is not cropped)
+    :param backend: segmentation backend used by frameData
+    :param background: full-frame background to subtract instead of inverting each frame
+    :param start: first frame to track (default 0)
+    :param stop: frame to stop before (default framecount)
+    :param prefetch: number of frames decoded ahead on a background thread (0 decodes in the main thread)
+    :param checkpoint: folder where results are saved every checkpoint_every frames, and when tracking fails.
+        If it holds a checkpoint of the same analysis, tracking resumes after the last saved frame
+    :param tolerant: frames that cannot be tracked get a row of NaNs and a failure code instead of stopping the
+        analysis (see failure_reasons)
+    :param head_fixed: HeadFixed, or True to estimate it from a sample of frames. The body axis is then locked and
+        only the eyes are segmented in each frame (see headFixedFrameData)
+    :param eye_windows: search for each eye in a small window around where it was in the previous frame, and
+        only search the whole frame when an eye is lost (see EyeWindows)
+    :return: TrackingResults
+    """
+    if start is None:
+        start = 0
+    if stop is None:
+        stop = video.framecount
+    if background is not None and roi is not None:
+        background = cropImage(background, roi)
+    if head_fixed is True:
+        head_fixed = sampleHeadFixed(video, thresh, roi, backend=backend, background=background)
+    windows = EyeWindows() if eye_windows else None
+
+    results = TrackingResults(stop - start)
+    if checkpoint is not None:
+        params = dict(video=video.fingerprint(), thresh=thresh, roi=roi, backend=backend,
+                      background=background is not None, gray=video.gray, start=start, stop=stop,
+                      head_fixed=head_fixed, eye_windows=eye_windows)
+        checkpoint = Checkpoint(checkpoint, params)
+        results.extend(checkpoint.load())
+        if checkpoint.last_frame is not None:
+            start = checkpoint.last_frame + 1
+    saved = len(results)
+
+    if prefetch:
+        frames = video.prefetchFrames(start, stop, depth=prefetch)
+    else:
+        frames = video.iterFrames(start, stop)
+
+    out = None
+    try:
+        for frame, img in frames:
+            #img = cv2.medianBlur(img, 9)
+            if roi is not None:
+                img = cropImage(img, roi)
+            if out is None and not head_fixed:
+                out = np.empty(img.shape[:2], dtype='uint8')
+            elif out is None:
+                x0, y0, x1, y1 = head_fixed.box
+                out = np.empty((y1 - y0, x1 - x0), dtype='uint8')
+            try:
+                if windows is not None:
+                    data = windows.frameData(img, thresh, backend=backend, background=background, head=head_fixed)
+                elif not head_fixed:
+                    data = frameData(img, thresh, backend=backend, background=background, out=out)
+                else:
+                    data = headFixedFrameData(img, thresh, head_fixed, backend=backend, background=background,
+                                              out=out)
+            except TrackingError as e:
+                if not tolerant:
+                    raise
+                results.addFailure(frame, e.code)
+            except Exception:
+                if not tolerant:
+                    raise
+                results.addFailure(frame, FRAME_ERROR)
+            else:
+                if data[3] is None or data[5] is None:
+                    results.addFrame(frame, data, NO_EYE_ANGLE)
+                else:
+                    results.addFrame(frame, data)
+            if checkpoint is not None and len(results) - saved >= checkpoint_every:
+                checkpoint.save(results.slice(saved))
+                saved = len(results)
+    finally:
+        if checkpoint is not None:
+            checkpoint.save(results.slice(saved))
+
+    return results
+
+
+def trackChunk(filepath, start, stop, thresh, roi=None, gray=False, **kwargs):
+    """Runs trackVideo on frames [start, stop) of a video opened separately, so it can run in a worker process"""
+    video = Video(filepath, gray=gray)
+    results = trackVideo(video, thresh, roi, start=start, stop=stop, **kwargs)
+    video.object.release()
+    return results
+
+
+def trackVideoParallel(video, thresh, roi=None, workers=None, chunk_size=None, **kwargs):
+    """
+    Splits the video into contiguous chunks of frames tracked by a pool of worker processes (each opens its own
+    copy of the video and seeks once per chunk), then merges the chunks back in frame order
+    :param workers: number of worker processes (None uses all cores)
+    :param chunk_size: frames per chunk (default: one chunk per worker)
+    :param kwargs: passed on to trackVideo (a checkpoint folder gets one sub-folder per chunk)
+    :return: TrackingResults, identical to trackVideo on the whole video
+    """
+    checkpoint = kwargs.pop('checkpoint', None)
+    if workers is None:
+        workers = os.cpu_count()
+    if chunk_size is None:
+        chunks = splitFrameRange(0, video.framecount, workers)
+    else:
+        starts = range(0, video.framecount, chunk_size)
+        chunks = [(start, min(start + chunk_size, video.framecount)) for start in starts]
+
+    results = TrackingResults(video.framecount)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for start, stop in chunks:
+            if checkpoint is not None:
+                kwargs['checkpoint'] = os.path.join(checkpoint, 'frames_{}_{}'.format(start, stop))
+            futures.append(executor.submit(trackChunk, video.filepath, start, stop, thresh, roi, video.gray, **kwargs))
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def lockHead(video, thresh, roi=None, backend='contours', background=None, **kwargs):
+    '''samples a video once to lock the body axis of a head-fixed fish for all the chunks or blocks tracked'''
+    if background is not None and roi is not None:
+        background = cropImage(background, roi)
+    return sampleHeadFixed(video, thresh, roi, backend=backend, background=background)
+
+
+def cacheParams(video, thresh, roi, **kwargs):
+    '''everything that determines the tracking results of a video, used as the ResultCache key'''
+    background = kwargs.get('background')
+    if background is not None:
+        background = hashlib.sha1(np.ascontiguousarray(background)).hexdigest()
+    start = kwargs.get('start')
+    stop = kwargs.get('stop')
+    return dict(video=video.fingerprint(), thresh=thresh, roi=roi, gray=video.gray,
+                backend=kwargs.get('backend', 'contours'), background=background,
+                start=0 if start is None else start, stop=video.framecount if stop is None else stop,
+                tolerant=kwargs.get('tolerant', False), head_fixed=kwargs.get('head_fixed', False),
+                eye_windows=kwargs.get('eye_windows', False), version=__version__)
+
+
+def analyseVideo(video, thresh, roi, workers=1, cache=None, **kwargs):
+    """
+    Main analysis function
+    :param video: Video class object (video_handling)
+    :param thresh: threshold used to find eyes and swimbladder
+    :param roi: crop each frame to ROI (if None then video is not cropped)
+    :param workers: number of processes used to track the video (see trackVideoParallel)
+    :param cache: ResultCache. If it holds results for the same video, parameters and version they are used
+        without decoding any frames
+    :param kwargs: passed on to trackVideo
+    :return: pandas DataFrame (frame number and vergence angles)y
+    """
+    results = None
+    if cache is not None:
+        params = cacheParams(video, thresh, roi, **kwargs)
+        results = cache.get(params)
+    if results is None:
+        if kwargs.get('head_fixed') is True:
+            kwargs['head_fixed'] = lockHead(video, thresh, roi, **kwargs)
+        if workers == 1:
+            results = trackVideo(video, thresh, roi, **kwargs)
+        else:
+            results = trackVideoParallel(video, thresh, roi, workers=workers, **kwargs)
+        if cache is not None:
+            cache.put(params, results)
+
+    df = vergenceData(results, status=kwargs.get('tolerant', False))
+    if kwargs.get('tolerant'):
+        printFailureSummary(results.failureCounts(), len(results), video.name)
+
+    return df
+
+
+def vergenceData(results, status=False):
+    """
+    :param results: TrackingResults
+    :param status: add the status code of each frame as a column
+    :return: pandas DataFrame (frame number and vergence angles)
+    """
+    vergence = vergenceAngles(results.column('heading'), results.column('left_angle'),
+                              results.column('right_angle'))
+    df = pd.DataFrame(dict(left=vergence.left, right=vergence.right), index=results.frames[:len(results)],
+                      columns=['left', 'right'])
+    if status:
+        df['status'] = results.status[:len(results)]
+
+    return df
+
+
+def streamVideo(video, thresh, sink, roi=None, block_size=1000, blockData=None, **kwargs):
+    """
+    Runs trackVideo in blocks of block_size frames. Each block is written to the sink as soon as it is tracked and
+    then dropped, so memory use does not grow with the length of the video
+    :param sink: ResultSink (see openSink)
+    :param blockData: function turning the TrackingResults of a block into the DataFrame that is written
+        (default: TrackingResults.toDataFrame)
+    :param kwargs: passed on to trackVideo (not checkpoint, the sink already holds everything tracked so far)
+    :return: dict of the number of frames with each failure code (see TrackingResults.failureCounts)
+    """
+    if kwargs.get('head_fixed') is True:
+        kwargs['head_fixed'] = lockHead(video, thresh, roi, **kwargs)
+    failures = {}
+    for start in range(0, video.framecount, block_size):
+        stop = min(start + block_size, video.framecount)
+        block = trackVideo(video, thresh, roi, start=start, stop=stop, **kwargs)
+        sink.write(blockData(block) if blockData is not None else block.toDataFrame(copy=False))
+        for code, count in block.failureCounts().items():
+            failures[code] = failures.get(code, 0) + count
+    return failures
+
+
+def failureSummary(failures):
+    '''number of frames that failed for each reason, from TrackingResults.failureCounts'''
+    return {failure_reasons.get(code, code): count for code, count in failures.items()}
+
+
+def printFailureSummary(failures, n_frames, name=''):
+    summary = failureSummary(failures)
+    if summary:
+        counts = ', '.join('{} {}'.format(count, reason) for reason, count in summary.items())
+        print('WARNING: {} of {} frames not tracked in {} ({})'.format(sum(summary.values()), n_frames, name,
+                                                                      counts))
+
+
+def analyseFile(filepath, thresh, roi, output_path, gray=False, checkpoint=False, stream=False, **kwargs):
+    """
+    Analyses one video file and saves the results (in the format given by the extension of output_path, see
+    writeResults), so it can run in a worker process
+    :param checkpoint: checkpoint the tracking in a <output_path>.checkpoint folder, which is deleted once the
+        results are saved (an interrupted analysis resumes from it when run again)
+    :param stream: append the results to output_path block by block while tracking (see streamVideo). Streamed
+        results cannot be checkpointed
+    """
+    if stream and checkpoint:
+        raise ValueError('streamed results cannot be checkpointed')
+    video = Video(filepath, gray=gray)
+    if stream:
+        # STREAMED RESULTS ARE TRACKED IN ONE PROCESS AND NOT CACHED
+        kwargs.pop('workers', None)
+        if kwargs.pop('cache', None) is not None:
+            print('WARNING: streamed results of {} are not cached'.format(os.path.basename(filepath)))
+        status = kwargs.get('tolerant', False)
+        with openSink(output_path) as sink:
+            failures = streamVideo(video, thresh, sink, roi, blockData=lambda block: vergenceData(block, status),
+                                   **kwargs)
+        if status:
+            printFailureSummary(failures, sink.rows, video.name)
+        video.object.release()
+        return output_path
+    checkpoint_folder = output_path + '.checkpoint' if checkpoint else None
+    data = analyseVideo(video, thresh, roi, checkpoint=checkpoint_folder, **kwargs)
+    video.object.release()
+    writeResults(data, output_path)
+    if checkpoint_folder is not None:
+        shutil.rmtree(checkpoint_folder, ignore_errors=True)
+    return output_path
+
+
+def outputPath(filepath, output_folder=None, extension='.csv'):
+    if output_folder is None:
+        output_folder = os.path.join(os.path.dirname(os.path.abspath(filepath)), 'results')
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(output_folder, name + extension)
+
+
+def manifestParams(thresh, roi, gray=False, backend='contours', tolerant=False, head_fixed=False, eye_windows=False,
+                   **kwargs):
+    '''the parameters that change the results of an analysis, as recorded in the manifest of the output folder'''
+    return dict(thresh=thresh, roi=roi, gray=gray, backend=backend, tolerant=tolerant,
+                head_fixed=bool(head_fixed), eye_windows=eye_windows, version=__version__)
+
+
+def batchAnalyse(filepaths, thresh, roi, output_folder, workers=None, gray=False, fmt='csv', force=False, **kwargs):
+    """
+    Analyses whole videos in a pool of worker processes that share one threshold and ROI. Videos are started
+    longest first so that one long video does not finish on its own at the end of the batch, and each result file
+    is written as soon as its video is finished. A single video is split between the workers instead.
+    Each output folder keeps a manifest of the videos analysed into it (see Manifest), and videos that were already
+    analysed with the same parameters and have not changed since are skipped
+    :param filepaths: video files to analyse
+    :param output_folder: folder where the results of each video are saved as <name>.<extension> (if None then
+        they are saved in a results folder next to each video)
+    :param fmt: output format (see writeResults)
+    :param workers: number of worker processes (None uses all cores)
+    :param force: analyse every video, even those the manifest records as already analysed
+    :param kwargs: passed on to analyseVideo
+    :return: dict of output path (None if the analysis failed) for each video
+    """
+    params = manifestParams(thresh, roi, gray, **kwargs)
+    outputs = {}
+    manifests = {}
+    pending = {}
+    for filepath in filepaths:
+        output_path = outputPath(filepath, output_folder, result_formats[fmt][0])
+        manifest_path = os.path.join(os.path.dirname(output_path), manifest_filename)
+        if manifest_path not in manifests:
+            manifests[manifest_path] = Manifest(manifest_path)
+        fingerprint = videoFingerprint(filepath)
+        if not force and manifests[manifest_path].isCurrent(filepath, fingerprint, params, output_path):
+            print('SKIPPING', os.path.basename(filepath), '(already analysed)')
+            outputs[filepath] = output_path
+            continue
+        pending[filepath] = (output_path, manifests[manifest_path], fingerprint)
+
+    def finished(filepath, output, error=None):
+        output_path, manifest, fingerprint = pending[filepath]
+        outputs[filepath] = output
+        if error is None:
+            manifest.record(filepath, fingerprint, params, output_path, 'done')
+            print('FINISHED', os.path.basename(filepath))
+        else:
+            manifest.record(filepath, fingerprint, params, output_path, 'failed', repr(error))
+            print('WARNING: analysis of {} failed ({!r})'.format(os.path.basename(filepath), error))
+
+    if len(pending) == 1:
+        # A SINGLE VIDEO IS SPLIT BETWEEN THE WORKERS INSTEAD
+        filepath = next(iter(pending))
+        print('ANALYZING', os.path.basename(filepath))
+        kwargs.setdefault('workers', workers if workers is not None else os.cpu_count())
+        try:
+            finished(filepath, analyseFile(filepath, thresh, roi, pending[filepath][0], gray, **kwargs))
+        except Exception as e:
+            finished(filepath, None, e)
+        return outputs
+
+    framecounts = {}
+    for filepath in pending:
+        video = Video(filepath)
+        framecounts[filepath] = video.framecount
+        video.object.release()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for filepath in sorted(pending, key=lambda f: framecounts[f], reverse=True):
+            future = executor.submit(analyseFile, filepath, thresh, roi, pending[filepath][0], gray, **kwargs)
+            futures[future] = filepath
+        for future in as_completed(futures):
+            filepath = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                finished(filepath, None, e)
+            else:
+                finished(filepath, output)
+    return outputs
+
+
+def checkTracking(video, thresh=200, roi=None):
+    """
+    Check that tracking is working
+    :param video: Video class object (video_handling)
+    :param thresh: threshold used to find eyes and swimbladder
+    :param roi: crop each frame to ROI (if None then video is not cropped)
+    :return: None
+    """
+    winname = video.name
+    video.addDisplay(winname, displayFunction=showEyes, displayKwargs={'thresh': thresh, 'roi': roi})
+    cv2.waitKey(0)
+    video.removeDisplay(winname)
+
+
+# COMMAND LINE #
+
+
+def findVideos(patterns, extension='.avi'):
+    """video files matching each path or glob pattern (folders are searched for files with the extension)"""
+    filepaths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path):
+                filepaths += sorted(glob.glob(os.path.join(path, '*' + extension)))
+            elif os.path.isfile(path):
+                filepaths.append(path)
+            else:
+                print('WARNING: no videos found for {}'.format(path))
+    return list(dict.fromkeys(filepaths))
+
+
+def manageCache(action, folder=None, max_bytes=None):
+    cache = ResultCache(folder)
+    if action == 'list':
+        for entry in cache.entries():
+            params = entry['params'] or {}
+            last_used = datetime.datetime.fromtimestamp(entry['last_used']).strftime('%Y-%m-%d %H:%M')
+            print('{}  {:>10d} B  {}  thresh={} roi={} backend={} version={}'.format(
+                entry['key'][:12], entry['size'], last_used, params.get('thresh'), params.get('roi'),
+                params.get('backend'), params.get('version')))
+    elif max_bytes is not None:
+        cache.max_bytes = max_bytes
+        cache.evict()
+    else:
+        cache.purge()
+    return 0
+
+
+def main(argv=None):
+    """
+    Headless entry point: python -m eye_tracker analyse <paths>
+    Never imports tkinter or opens OpenCV windows, so it can run without a display
+    """
+    parser = argparse.ArgumentParser(prog='eye_tracker', description='zebrafish eye tracking')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    analyse = subparsers.add_parser('analyse', help='analyse videos and save the vergence angles')
+    analyse.add_argument('paths', nargs='+', help='video files, folders or glob patterns')
+    analyse.add_argument('--roi', nargs=4, type=int, metavar=('X1', 'Y1', 'X2', 'Y2'),
+                         help='crop each frame to this ROI')
+    analyse.add_argument('--thresh', type=int, default=200, help='threshold used to find eyes and swimbladder')
+    analyse.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    analyse.add_argument('--output', default=None,
+                         help='output folder (default: a results folder next to each video)')
+    analyse.add_argument('--format', default='csv', choices=list(result_formats), help='output format')
+    analyse.add_argument('--backend', default='contours', choices=['contours', 'components'],
+                         help='segmentation backend')
+    analyse.add_argument('--gray', action='store_true', help='decode frames as single-channel grayscale')
+    analyse.add_argument('--tolerant', action='store_true',
+                         help='save NaNs and a failure code for frames that cannot be tracked instead of stopping')
+    analyse.add_argument('--stream', action='store_true',
+                         help='append results to the output file while tracking (csv, hdf5 or parquet)')
+    analyse.add_argument('--checkpoint', action='store_true',
+                         help='save progress while tracking and resume interrupted analyses')
+    analyse.add_argument('--cache', nargs='?', const=result_cache_folder, default=None, metavar='FOLDER',
+                         help='reuse results of videos already analysed with the same parameters '
+                              '(default folder: {})'.format(result_cache_folder))
+    analyse.add_argument('--head-fixed', action='store_true',
+                         help='lock the body axis from a sample of frames and only track the eyes in each frame')
+    analyse.add_argument('--eye-windows', action='store_true',
+                         help='search for each eye in a small window around where it was in the previous frame')
+    analyse.add_argument('--force', action='store_true',
+                         help='analyse every video, including those the manifest of the output folder records as '
+                              'already analysed')
+
+    cache = subparsers.add_parser('cache', help='list or purge cached results')
+    cache.add_argument('action', choices=['list', 'purge'])
+    cache.add_argument('--folder', default=result_cache_folder, help='cache folder')
+    cache.add_argument('--max-bytes', type=int, default=None,
+                       help='only purge least recently used entries, down to this total size')
+
+    args = parser.parse_args(argv)
+    if args.command == 'analyse' and args.stream:
+        if args.checkpoint:
+            parser.error('--stream and --checkpoint cannot be used together')
+        if args.cache is not None:
+            parser.error('--stream and --cache cannot be used together')
+        if args.format not in result_sinks:
+            parser.error('--stream only supports --format {}'.format('|'.join(result_sinks)))
+
+    if args.command == 'cache':
+        return manageCache(args.action, args.folder, args.max_bytes)
+
+    result_cache = ResultCache(args.cache) if args.cache is not None else None
+    filepaths = findVideos(args.paths)
+    if not filepaths:
+        print('no videos to analyse')
+        return 1
+    roi = None
+    if args.roi is not None:
+        roi = (tuple(args.roi[:2]), tuple(args.roi[2:]))
+
+    outputs = batchAnalyse(filepaths, args.thresh, roi, args.output, args.workers, args.gray, args.format,
+                           args.force, checkpoint=args.checkpoint, stream=args.stream, backend=args.backend,
+                           tolerant=args.tolerant, head_fixed=args.head_fixed, eye_windows=args.eye_windows,
+                           cache=result_cache)
+
+    failed = [filepath for filepath, output in outputs.items() if output is None]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
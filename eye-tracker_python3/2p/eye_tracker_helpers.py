@@ -1,11 +1,40 @@
+import time
+from collections import namedtuple
+
 from video_handling import *
 from geometry_helpers import *
 
 
+# TRACKING FAILURES #
+
+
+# STATUS CODES STORED FOR EACH FRAME (0 IS A TRACKED FRAME)
+TOO_FEW_BLOBS = 1
+NO_EYE_ANGLE = 2
+FRAME_ERROR = 3
+failure_reasons = {TOO_FEW_BLOBS: 'too few blobs', NO_EYE_ANGLE: 'no eye angle', FRAME_ERROR: 'error'}
+
+
+class TrackingError(Exception):
+    '''raised when the swim bladder and eyes cannot be found in a frame'''
+
+    def __init__(self, code, message=None):
+        Exception.__init__(self, message or failure_reasons[code])
+        self.code = code
+
+    def __reduce__(self):
+        # SO THE ERROR CAN BE SENT BACK FROM WORKER PROCESSES
+        return TrackingError, (self.code, str(self))
+
+
 # CONTOUR FUNCTIONS #
 
 
-def contourCentre(contour):
+# MOMENTS AND (x, y, w, h) BOUNDING BOX OF A BLOB, COMPUTED ONCE PER FRAME AND SHARED BY ALL THE GEOMETRY IN frameData
+BlobFeatures = namedtuple('BlobFeatures', ['m00', 'centre', 'mu20', 'mu11', 'mu02', 'box'], defaults=(None,))
+
+
+def contourFeatures(contour):
     moments = cv2.moments(contour)
     if moments["m00"] != 0:
         c = moments["m10"] / moments["m00"], moments["m01"] / moments["m00"]
@@ -15,7 +44,12 @@ def contourCentre(contour):
         else:
             points = contour.squeeze().tolist()
             c = findMidpoint(*points)
-    return c
+    box = cv2.boundingRect(contour)
+    return BlobFeatures(moments["m00"], c, moments["mu20"], moments["mu11"], moments["mu02"], box)
+
+
+def contourCentre(contour):
+    return contourFeatures(contour).centre
 
 
 def contourAngle(contour):
@@ -33,24 +67,48 @@ def contourAngle(contour):
         return theta
 
 
-def findSwimBladder(contours):
-    cs = [contourCentre(cnt) for cnt in contours]
+def findSwimBladder(blobs):
+    # THE EYES ARE THE CLOSEST PAIR OF BLOB CENTRES
+    cs = [blob.centre for blob in blobs]
     ds = [distance(p1, p2) for p1, p2 in zip([cs[0], cs[0], cs[1]], [cs[1], cs[2], cs[2]])]
     shortest_i = ds.index(min(ds))
     sb_i = 2-shortest_i
     return sb_i
 
 
-def findAllContours(image, thresh):
+def findAllContours(image, thresh, background=None, out=None):
     #image = cv2.medianBlur(image, 11)
-    white = np.full(image.shape, 255, dtype='uint8')
-    inverted = white-image
-    threshed = applyThreshold(inverted, thresh, 'binary')
+    threshed = binariseImage(image, thresh, background, out)
     contours = findContours(threshed)
     internals = contours[:3]
     return internals
 
 
+def findAllComponents(image, thresh, n=3, background=None, out=None):
+    """
+    Connected-components alternative to findAllContours: labels the thresholded image in a single pass, which
+    gives the area and centroid of every blob, and only computes moments for the n largest
+    :return: list of BlobFeatures of the n largest blobs, largest first
+    """
+    threshed = binariseImage(image, thresh, background, out)
+    count, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(threshed, 8, cv2.CV_32S,
+                                                                                   cv2.CCL_BBDT)
+    areas = stats[1:, cv2.CC_STAT_AREA] # LABEL 0 IS THE BACKGROUND
+    if len(areas) > n:
+        largest = np.argpartition(areas, len(areas)-n)[len(areas)-n:]
+    else:
+        largest = np.arange(len(areas))
+    largest = largest[np.argsort(-areas[largest], kind='stable')] + 1
+    blobs = []
+    for i in largest:
+        x, y, w, h = stats[i, :4]
+        mask = np.equal(labels[y:y+h, x:x+w], i).view(np.uint8)
+        moments = cv2.moments(mask, binaryImage=True)
+        blobs.append(BlobFeatures(moments["m00"], tuple(centroids[i]), moments["mu20"], moments["mu11"],
+                                  moments["mu02"], (int(x), int(y), int(w), int(h))))
+    return blobs
+
+
 # ADJUST THRESHOLDS #
 
 
@@ -102,35 +160,52 @@ def mod2pi(angle):
 
 
 def abs_angle_diff(a, b):
-    angle = abs(mod2pi(a) - mod2pi(b))
-    if np.pi * 2 - angle < angle:
-        return np.pi * 2 - angle
-    return angle
+    angle = np.abs(mod2pi(a) - mod2pi(b))
+    return np.minimum(angle, np.pi * 2 - angle)
 
 
 def longAxisAngle(contour, heading):
     if len(contour) == 1:
         return
-    moments = cv2.moments(contour)
-    m00 = moments["m00"]
-    m10 = moments["m10"]
-    m01 = moments["m01"]
-    m11 = moments["m11"]
-    m02 = moments["m02"]
-    m20 = moments['m20']
-
-    x = m10 / m00
-    y = m01 / m00
-
-    a = m20 / m00 - x ** 2
-    b = 2 * (m11 / m00 - x * y)
-    c = m02 / m00 - y ** 2
-
-    theta = 0.5 * np.arctan(b / (a - c)) + (a < c) * np.pi / 2
-    theta_1 = mod2pi(theta + np.pi)
-    if abs_angle_diff(theta_1, heading) < abs_angle_diff(theta, heading):
-        return theta_1
-    return theta
+    return blobLongAxisAngle(contourFeatures(contour), heading)
+
+
+def blobLongAxisAngle(blob, heading):
+    angle = float(longAxisAngles(blob.m00, blob.mu20, blob.mu11, blob.mu02, heading))
+    if not math.isfinite(angle):
+        # NO AREA, OR NO LONG AXIS (e.g. A SQUARE BLOB)
+        return
+    return angle
+
+
+def centralMoments(m00, m10, m01, m20, m11, m02):
+    '''central second moments (mu20, mu11, mu02) from arrays of raw moments'''
+    m00, m10, m01 = np.asarray(m00, dtype=float), np.asarray(m10, dtype=float), np.asarray(m01, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = m10 / m00
+        y = m01 / m00
+    return m20 - (x * m10), m11 - (x * m01), m02 - (y * m01)
+
+
+def longAxisAngles(m00, mu20, mu11, mu02, heading=None):
+    """
+    Long axis angles of many blobs at once, e.g. the eyes of every frame of a video, from their moments (use
+    centralMoments to convert raw moments first)
+    :param m00, mu20, mu11, mu02: arrays of the area and central second moments of each blob
+    :param heading: array of body axis angles (or one angle for all blobs). Each long axis angle is flipped to
+        whichever of its two directions is closer to the heading. If None the angles are not disambiguated
+    :return: array of angles (radians, NaN for blobs with no area or no long axis)
+    """
+    m00 = np.asarray(m00, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = mu20 / m00
+        b = 2 * np.asarray(mu11, dtype=float) / m00
+        c = mu02 / m00
+        theta = 0.5 * np.arctan(b / (a - c)) + (a < c) * np.pi / 2
+    if heading is not None:
+        theta_1 = mod2pi(theta + np.pi)
+        theta = np.where(abs_angle_diff(theta_1, heading) < abs_angle_diff(theta, heading), theta_1, theta)
+    return np.where(m00 == 0, np.nan, theta)
 # FROM TOMMY -------
 '''
 
@@ -160,13 +235,37 @@ def longAxisAngle(contour, theta):
 '''
 
 
-def frameData(image, thresh):
-    contours = findAllContours(image, thresh=thresh)
-    sb_i = findSwimBladder(contours)
-    sb = contours.pop(sb_i)
-    c = contourCentre(sb)
-
-    eye_cs = [contourCentre(eye) for eye in contours]
+def findBlobs(image, thresh, backend='contours', background=None, out=None):
+    '''BlobFeatures of the three largest blobs, found with the given segmentation backend'''
+    if backend == 'contours':
+        contours = findAllContours(image, thresh=thresh, background=background, out=out)
+        return [contourFeatures(cnt) for cnt in contours]
+    elif backend == 'components':
+        return findAllComponents(image, thresh=thresh, background=background, out=out)
+    else:
+        raise ValueError('invalid segmentation backend')
+
+
+def frameData(image, thresh, backend='contours', background=None, out=None):
+    """
+    Finds the swim bladder and both eyes in a frame
+    :param image: frame (cropped to the ROI)
+    :param thresh: threshold used to find eyes and swimbladder
+    :param backend: segmentation used to find the blobs, 'contours' (findAllContours) or 'components'
+        (findAllComponents)
+    :param background: subtract this background (cropped like image) instead of inverting the frame
+    :param out: preallocated threshold buffer (see binariseImage)
+    :return: body centre, heading, left eye centre, left eye angle, right eye centre, right eye angle
+    """
+    blobs = findBlobs(image, thresh, backend, background, out)
+    if len(blobs) < 3:
+        raise TrackingError(TOO_FEW_BLOBS, 'found {} blobs'.format(len(blobs)))
+
+    sb_i = findSwimBladder(blobs)
+    sb = blobs.pop(sb_i)
+    c = sb.centre
+
+    eye_cs = [eye.centre for eye in blobs]
     eye_c_xs, eye_c_ys = zip(*eye_cs)
     mp = findMidpoint(*eye_cs)
 
@@ -186,17 +285,222 @@ def frameData(image, thresh):
         # RIGHT
         left_i = eye_c_ys.index(min(eye_c_ys))
 
-    eye_l = contours.pop(left_i)
-    eye_l_c = eye_cs.pop(left_i)
-    eye_l_th = longAxisAngle(eye_l, orientation)
+    eye_l = blobs.pop(left_i)
+    eye_l_c = eye_l.centre
+    eye_l_th = blobLongAxisAngle(eye_l, orientation)
 
-    eye_r = contours.pop()
-    eye_r_c = eye_cs.pop()
-    eye_r_th = longAxisAngle(eye_r, orientation)
+    eye_r = blobs.pop()
+    eye_r_c = eye_r.centre
+    eye_r_th = blobLongAxisAngle(eye_r, orientation)
 
     return c, orientation, eye_l_c, eye_l_th, eye_r_c, eye_r_th
 
 
+# HEAD-FIXED TRACKING #
+
+
+# BODY CENTRE AND HEADING, REFERENCE CENTRES OF THE LEFT AND RIGHT EYES, THE (x0, y0, x1, y1) BOX AROUND THE EYES AND
+# HOW FAR AN EYE CAN BE FROM ITS REFERENCE CENTRE
+HeadFixed = namedtuple('HeadFixed', ['centre', 'heading', 'left', 'right', 'box', 'margin'])
+
+
+def estimateHeadFixed(images, thresh, backend='contours', background=None, margin=None):
+    """
+    Estimates the body centre, heading and eye positions of a head-fixed fish from a sample of frames, so that they
+    can be locked for a whole video (see headFixedFrameData)
+    :param images: sample of frames (cropped the same way as the frames that will be tracked)
+    :param margin: pixels kept around the eye centres in the eye region, and how far an eye can be from its
+        reference centre in a tracked frame (default: half the distance between eyes)
+    :return: HeadFixed
+    """
+    data = []
+    for image in images:
+        try:
+            data.append(frameData(image, thresh, backend, background))
+        except TrackingError:
+            continue
+    if not data:
+        raise TrackingError(TOO_FEW_BLOBS, 'the fish was not found in any sample frame')
+    centres = np.array([d[0] for d in data])
+    headings = np.array([d[1] for d in data])
+    lefts = np.array([d[2] for d in data])
+    rights = np.array([d[4] for d in data])
+
+    centre = tuple(np.median(centres, axis=0).tolist())
+    heading = float(mod2pi(np.arctan2(np.sin(headings).mean(), np.cos(headings).mean()))) # CIRCULAR MEAN
+    left = tuple(np.median(lefts, axis=0).tolist())
+    right = tuple(np.median(rights, axis=0).tolist())
+    if margin is None:
+        margin = 0.5 * distance(left, right)
+
+    eyes = np.concatenate([lefts, rights])
+    height, width = images[0].shape[:2]
+    x0, y0 = np.maximum(np.floor(eyes.min(axis=0) - margin), 0).astype(int)
+    x1, y1 = np.minimum(np.ceil(eyes.max(axis=0) + margin) + 1, (width, height)).astype(int)
+    return HeadFixed(centre, heading, left, right, (int(x0), int(y0), int(x1), int(y1)), float(margin))
+
+
+def sampleHeadFixed(video, thresh, roi=None, n_frames=20, backend='contours', background=None):
+    '''estimateHeadFixed from n_frames spread evenly through a video (background must already be cropped to roi)'''
+    images = []
+    for n in sorted(set(np.linspace(0, video.framecount - 1, n_frames).astype(int))):
+        img = video.grabFrameN(int(n))
+        if roi is not None:
+            img = cropImage(img, roi)
+        images.append(img)
+    return estimateHeadFixed(images, thresh, backend, background)
+
+
+def headFixedFrameData(image, thresh, head, backend='contours', background=None, out=None):
+    """
+    frameData for a head-fixed fish: the body centre, heading and sides of the eyes are locked (see
+    estimateHeadFixed), so only the box around the eyes is segmented and the swim bladder is never searched for
+    :param head: HeadFixed
+    :param out: uint8 buffer the size of the eye box
+    :return: body centre, heading, left eye centre, left eye angle, right eye centre, right eye angle
+    """
+    x0, y0, x1, y1 = head.box
+    image = image[y0:y1, x0:x1]
+    if background is not None:
+        background = background[y0:y1, x0:x1]
+    blobs = findBlobs(image, thresh, backend, background, out)
+    if len(blobs) < 2:
+        raise TrackingError(TOO_FEW_BLOBS, 'found {} eyes'.format(len(blobs)))
+
+    # THE EYES ARE THE PAIR OF BLOBS CLOSEST TO THE REFERENCE EYE CENTRES
+    left = (head.left[0] - x0, head.left[1] - y0)
+    right = (head.right[0] - x0, head.right[1] - y0)
+    pairs = [(i, j) for i in range(len(blobs)) for j in range(len(blobs)) if i != j]
+    costs = [distance(blobs[i].centre, left) + distance(blobs[j].centre, right) for i, j in pairs]
+    eye_l, eye_r = [blobs[i] for i in pairs[costs.index(min(costs))]]
+    # A MISSING EYE (e.g. A BLINK) IS NOT REPLACED BY ANOTHER BLOB FROM THE EYE BOX
+    if distance(eye_l.centre, left) > head.margin or distance(eye_r.centre, right) > head.margin:
+        raise TrackingError(TOO_FEW_BLOBS, 'eyes not found near their locked positions')
+
+    eye_l_c = (eye_l.centre[0] + x0, eye_l.centre[1] + y0)
+    eye_l_th = blobLongAxisAngle(eye_l, head.heading)
+    eye_r_c = (eye_r.centre[0] + x0, eye_r.centre[1] + y0)
+    eye_r_th = blobLongAxisAngle(eye_r, head.heading)
+
+    return head.centre, head.heading, eye_l_c, eye_l_th, eye_r_c, eye_r_th
+
+
+# EYE WINDOWS #
+
+
+class EyeWindows(object):
+    """
+    Tracks each eye (and the swim bladder, unless the fish is head-fixed) in a small search window centred on where
+    it was found in the previous frame, instead of segmenting the whole frame. When a blob is lost from its window
+    (no blob, one cut off by the edge of the window, or one much smaller than before) or two windows find the same
+    blob, the frame is tracked with a full frame search, which also re-centres the windows
+    :param size: half the width of each square window in pixels (default: 0.75 times the distance between the eyes
+        in the first frame)
+    :param min_area_ratio: a blob smaller than this fraction of its area in the previous frame counts as lost
+    """
+
+    def __init__(self, size=None, min_area_ratio=0.5):
+
+        self.size = size
+        self.min_area_ratio = min_area_ratio
+        self.centres = None # SWIM BLADDER, LEFT EYE AND RIGHT EYE IN THE PREVIOUS FRAME
+        self.areas = [None, None, None]
+        self.fallbacks = 0
+
+    ############################
+
+    def window(self, image, centre):
+        '''(x0, y0, x1, y1) box of the window around centre, clipped to the image'''
+        x, y = int(round(centre[0])), int(round(centre[1]))
+        height, width = image.shape[:2]
+        x0, y0 = max(x - self.size, 0), max(y - self.size, 0)
+        return x0, y0, min(x + self.size + 1, width), min(y + self.size + 1, height)
+
+    def findBlob(self, image, thresh, i, backend='contours', background=None):
+        '''the blob closest to centre i of the previous frame within its window (None if it is lost)'''
+        x0, y0, x1, y1 = self.window(image, self.centres[i])
+        if background is not None:
+            background = background[y0:y1, x0:x1]
+        blobs = findBlobs(image[y0:y1, x0:x1], thresh, backend, background)
+        if not blobs:
+            return
+        previous = (self.centres[i][0] - x0, self.centres[i][1] - y0)
+        ds = [distance(blob.centre, previous) for blob in blobs]
+        blob = blobs[ds.index(min(ds))]
+        if blob.m00 == 0 or (self.areas[i] is not None and blob.m00 < self.min_area_ratio * self.areas[i]):
+            return
+        # A BLOB TOUCHING AN EDGE OF THE WINDOW THAT IS NOT THE EDGE OF THE IMAGE IS CUT OFF BY THE WINDOW
+        x, y, w, h = blob.box
+        height, width = image.shape[:2]
+        if (x == 0 < x0) or (y == 0 < y0) or (x + w == x1 - x0 and x1 < width) or (y + h == y1 - y0 and y1 < height):
+            return
+        self.areas[i] = blob.m00
+        return blob._replace(centre=(blob.centre[0] + x0, blob.centre[1] + y0), box=(x + x0, y + y0, w, h))
+
+    def frameData(self, image, thresh, backend='contours', background=None, head=None):
+        """
+        :param head: HeadFixed (see headFixedFrameData), in which case only the eyes are tracked
+        :return: same as frameData
+        """
+        if self.centres is not None:
+            parts = [1, 2] if head else [0, 1, 2]
+            blobs = [self.findBlob(image, thresh, i, backend, background) for i in parts]
+            found = all(blob is not None for blob in blobs)
+            if found and len(set(blob.box for blob in blobs)) == len(blobs):
+                eye_l, eye_r = blobs[-2:]
+                if head:
+                    c, orientation = head.centre, head.heading
+                else:
+                    c = blobs[0].centre
+                    orientation = angleAB(c, findMidpoint(eye_l.centre, eye_r.centre))
+                self.centres = [c, eye_l.centre, eye_r.centre]
+                return (c, orientation, eye_l.centre, blobLongAxisAngle(eye_l, orientation),
+                        eye_r.centre, blobLongAxisAngle(eye_r, orientation))
+            self.fallbacks += 1
+
+        if head:
+            data = headFixedFrameData(image, thresh, head, backend, background)
+        else:
+            data = frameData(image, thresh, backend, background)
+        self.centres = [data[0], data[2], data[4]]
+        self.areas = [None, None, None]
+        if self.size is None:
+            self.size = int(round(0.75 * distance(data[2], data[4])))
+        return data
+
+
+# VERGENCE #
+
+
+Vergence = namedtuple('Vergence', ['left', 'right', 'vergence', 'version'])
+
+
+def vergenceAngles(heading, left_angle, right_angle, degrees=True):
+    """
+    Eye angles relative to the body axis for a whole recording in one pass. The tracking only produces raw angles,
+    and these are derived from them afterwards.
+    To calculate vergence angles:
+        - Angles increase CCW and a converged eye points towards the midline
+        - A converged left eye has a greater CCW angle than the body axis
+        - CW and CCW are reversed
+        - Angles greater than 180 degrees must be divergent
+    :param heading: (N,) array of body axis angles (radians)
+    :param left_angle: (N,) array of left eye angles (radians, NaN for untracked frames)
+    :param right_angle: (N,) array of right eye angles (radians, NaN for untracked frames)
+    :param degrees: return degrees instead of radians
+    :return: Vergence of (N,) arrays: vergence of each eye (positive when converged), binocular vergence (left +
+        right) and version ((left - right) / 2, the conjugate rotation of both eyes)
+    """
+    left = findClockwiseAngles(heading, left_angle)
+    right = findClockwiseAngles(right_angle, heading)
+    left = np.where(left > np.pi, left - 2 * np.pi, left)
+    right = np.where(right > np.pi, right - 2 * np.pi, right)
+    if degrees:
+        left = np.degrees(left)
+        right = np.degrees(right)
+    return Vergence(left, right, left + right, (left - right) / 2)
+
+
 # CHECK TRACKING HELPERS #
 
 
@@ -218,7 +522,10 @@ def showEyes(image, thresh, roi):
 
     c, th, l_c, l_phi, r_c, r_phi = frameData(img, thresh)
 
-    show = cv2.cvtColor(img, cv2.cv.CV_GRAY2BGR)
+    if img.ndim == 2:
+        show = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    else:
+        show = np.copy(img)
     blue = (255, 0, 0)
     green = (0, 255, 0)
 
@@ -228,3 +535,27 @@ def showEyes(image, thresh, roi):
     return show
 
 
+# BENCHMARKS #
+
+
+def benchmarkSegmentation(video, thresh, roi=None, n_frames=200, backends=('contours', 'components')):
+    """
+    Times frameData with each segmentation backend on the same decoded frames
+    :return: dict of mean seconds per frame for each backend
+    """
+    frames = []
+    for n, img in video.iterFrames(0, min(n_frames, video.framecount)):
+        if roi is not None:
+            img = cropImage(img, roi)
+        frames.append(img)
+    timings = {}
+    for backend in backends:
+        t0 = time.perf_counter()
+        for img in frames:
+            try:
+                frameData(img, thresh, backend=backend)
+            except TrackingError:
+                pass
+        timings[backend] = (time.perf_counter() - t0) / len(frames)
+        print('{}: {:.3f} ms per frame'.format(backend, 1000 * timings[backend]))
+    return timings
@@ -5,10 +5,7 @@ import numpy as np
 
 def distance(a, b):
     '''Pythagoras: finds the distance between two points (a1, a2), (b1, b2)'''
-    deltax2 = (b[0]-a[0])**2
-    deltay2 = (b[1]-a[1])**2
-    ab = math.sqrt(deltax2 + deltay2)
-    return ab
+    return float(distances(a, b))
 
 
 def angleABC(a, b, c):
@@ -62,56 +59,78 @@ def lineintersect(m1, c1, m2, c2):
 
 def point2line(a, b, c):
     '''finds shortest distance between point c and line ab'''
-    m1, y1 = line(a, b)
-    m2 = invgrad(m1)
-    y2 = yintercept(m2, c)
-    d = lineintersect((m1, y1), (m2, y2))
-    answer = distance(c, d)
-    return answer
+    ab = vector(a, b)
+    ac = vector(a, c)
+    return abs((ab[0] * ac[1]) - (ab[1] * ac[0])) / distance(a, b)
 
 
 def angleAB(a, b):
-    dx, dy = vector(a, b)
-    angle = math.atan2(dy, dx)
-    if angle < 0:
-        angle += (2 * math.pi)
-    return angle
+    '''angle of the vector from point a to point b, between 0 and 2pi'''
+    return float(anglesAB(a, b))
 
 
 def vector(a, b):
-    dx = float(b[0]) - float(a[0])
-    dy = float(b[1]) - float(a[1])
-    return (dx, dy)
+    return tuple(vectors(a, b).tolist())
 
 
 def findClockwiseAngle(angle1, angle2, unit='radians'):
     '''finds the clockwise angle from angle1 to angle2'''
-    if unit == 'radians':
-        a1, a2 = (2 * math.pi + angle1) % (2 * math.pi), (2 * math.pi + angle2) % (2 * math.pi)
-        difference = a2 - a1
-        if difference < 0:
-            difference = difference + 2 * math.pi
-        return difference
-    elif unit == 'degrees':
-        a1, a2 = (360 + angle1) % 360, (360 + angle2) % 360
-        difference = a2 - a1
-        if difference < 0:
-            difference = difference + 360
-        return difference
+    return float(findClockwiseAngles(angle1, angle2, unit))
 
 
 def findMidpoint(*points):
-    n = len(points)
-    xs, ys = zip(*points)
-    x = sum(xs) * (1.0/n)
-    y = sum(ys) * (1.0/n)
-    return (x, y)
+    return tuple(findMidpoints(*points).tolist())
 
 
 def angle2vector(rad):
-    theta = rad % (2 * math.pi)
-    v = np.array([1, math.tan(theta)])
-    v /= np.linalg.norm(v)
-    if math.pi / 2 < theta <= 3 * math.pi / 2:
-        v *= -1
-    return v
+    '''unit vector pointing in the direction of an angle'''
+    return angles2vectors(rad)
+
+
+# ARRAY FUNCTIONS #
+# THESE TAKE (N, 2) ARRAYS OF POINTS AND (N,) ARRAYS OF ANGLES, SO A WHOLE RECORDING CAN BE PROCESSED IN ONE CALL.
+# SINGLE POINTS AND ANGLES WORK TOO, AND NaNs PROPAGATE TO THE OUTPUT
+
+
+def vectors(a, b):
+    '''vectors from points a to points b'''
+    return np.asarray(b, dtype=float) - np.asarray(a, dtype=float)
+
+
+def distances(a, b):
+    '''distances between points a and points b'''
+    d = vectors(a, b)
+    return np.hypot(d[..., 0], d[..., 1])
+
+
+def anglesAB(a, b):
+    '''angles of the vectors from points a to points b, between 0 and 2pi'''
+    d = vectors(a, b)
+    angles = np.arctan2(d[..., 1], d[..., 0])
+    return np.where(angles < 0, angles + 2 * np.pi, angles)
+
+
+def findClockwiseAngles(angle1, angle2, unit='radians'):
+    '''finds the clockwise angles from angle1 to angle2, in radians or degrees'''
+    if unit == 'radians':
+        full = 2 * np.pi
+    elif unit == 'degrees':
+        full = 360.
+    else:
+        raise ValueError('unit must be radians or degrees, not {}'.format(unit))
+    a1 = np.mod(full + np.asarray(angle1, dtype=float), full)
+    a2 = np.mod(full + np.asarray(angle2, dtype=float), full)
+    difference = a2 - a1
+    return np.where(difference < 0, difference + full, difference)
+
+
+def findMidpoints(*points):
+    '''midpoints of any number of point arrays'''
+    points = np.stack([np.asarray(p, dtype=float) for p in points])
+    return points.sum(axis=0) * (1.0 / len(points))
+
+
+def angles2vectors(rad):
+    '''unit vectors pointing in the direction of each angle'''
+    rad = np.asarray(rad, dtype=float)
+    return np.stack([np.cos(rad), np.sin(rad)], axis=-1)
@@ -0,0 +1,502 @@
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+result_cache_folder = os.path.join(os.path.expanduser('~'), '.eye_tracker_cache')
+manifest_filename = 'manifest.json'
+result_columns = ['body_x', 'body_y', 'heading', 'left_x', 'left_y', 'left_angle', 'right_x', 'right_y', 'right_angle']
+
+
+def flattenFrameData(data):
+    '''flattens the output of frameData into one value per result column (missing eye angles become NaN)'''
+    c, th, l_c, l_th, r_c, r_th = data
+    l_th = math.nan if l_th is None else l_th
+    r_th = math.nan if r_th is None else r_th
+    return c[0], c[1], th, l_c[0], l_c[1], l_th, r_c[0], r_c[1], r_th
+
+
+class TrackingResults(object):
+    """
+    Per-frame output of frameData, stored in preallocated float64 column arrays that double in size when full
+    (one contiguous array per column, plus the frame numbers and a uint8 status code, 0 for tracked frames)
+    """
+
+    def __init__(self, capacity=1024):
+
+        capacity = max(1, int(capacity))
+        self.frames = np.empty(capacity, dtype='i8')
+        self.values = np.empty((len(result_columns), capacity), dtype='f8')
+        self.status = np.empty(capacity, dtype='u1')
+        self.n = 0
+
+    ############################
+
+    def __len__(self):
+        return self.n
+
+    def addFrame(self, frame, data, status=0):
+        if self.n == len(self.frames):
+            self.resize(2 * len(self.frames))
+        self.frames[self.n] = frame
+        self.values[:, self.n] = flattenFrameData(data)
+        self.status[self.n] = status
+        self.n += 1
+
+    def addFailure(self, frame, status):
+        '''adds a row of NaNs for a frame that could not be tracked'''
+        if self.n == len(self.frames):
+            self.resize(2 * len(self.frames))
+        self.frames[self.n] = frame
+        self.values[:, self.n] = math.nan
+        self.status[self.n] = status
+        self.n += 1
+
+    def resize(self, capacity):
+        capacity = max(capacity, self.n, 1)
+        frames = np.empty(capacity, dtype='i8')
+        values = np.empty((len(result_columns), capacity), dtype='f8')
+        status = np.empty(capacity, dtype='u1')
+        frames[:self.n] = self.frames[:self.n]
+        values[:, :self.n] = self.values[:, :self.n]
+        status[:self.n] = self.status[:self.n]
+        self.frames = frames
+        self.values = values
+        self.status = status
+
+    def extend(self, other):
+        if self.n + other.n > len(self.frames):
+            self.resize(max(2 * len(self.frames), self.n + other.n))
+        self.frames[self.n:self.n + other.n] = other.frames[:other.n]
+        self.values[:, self.n:self.n + other.n] = other.values[:, :other.n]
+        self.status[self.n:self.n + other.n] = other.status[:other.n]
+        self.n += other.n
+
+    def slice(self, start, stop=None):
+        '''copy of the results in rows [start, stop)'''
+        if stop is None:
+            stop = self.n
+        sliced = TrackingResults(stop - start)
+        sliced.frames[:stop - start] = self.frames[start:stop]
+        sliced.values[:, :stop - start] = self.values[:, start:stop]
+        sliced.status[:stop - start] = self.status[start:stop]
+        sliced.n = stop - start
+        return sliced
+
+    def column(self, name):
+        return self.values[result_columns.index(name), :self.n]
+
+    def failureCounts(self):
+        '''number of frames with each non-zero status code'''
+        codes, counts = np.unique(self.status[:self.n], return_counts=True)
+        return {int(code): int(count) for code, count in zip(codes, counts) if code != 0}
+
+    def toDataFrame(self, copy=True):
+        """
+        :param copy: if False the DataFrame shares memory with these results (and must not outlive changes to them)
+        :return: pandas DataFrame with one row per frame, indexed by frame number, with a status column
+        """
+        index = pd.Index(self.frames[:self.n], name='frame', copy=copy)
+        # THE TRANSPOSE OF THE COLUMN ARRAYS IS A VIEW WITH THE LAYOUT PANDAS STORES A FLOAT BLOCK IN
+        df = pd.DataFrame(self.values[:, :self.n].T, index=index, columns=result_columns, copy=copy)
+        # A SERIES BUILT WITHOUT COPYING IS INSERTED AS IT IS (df['status'] = array WOULD COPY IT)
+        status = pd.Series(self.status[:self.n], index=index, name='status', copy=copy)
+        return df.assign(status=status)
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, frames=self.frames[:self.n], values=self.values[:, :self.n], status=self.status[:self.n])
+        os.replace(path + '.tmp', path)
+
+
+def loadResults(path):
+    with np.load(path) as data:
+        results = TrackingResults(len(data['frames']))
+        results.frames[:] = data['frames']
+        results.values[:] = data['values']
+        results.status[:] = data['status']
+        results.n = len(data['frames'])
+    return results
+
+
+class Checkpoint(object):
+    """
+    Tracking results saved incrementally to a folder as .npz chunks, with a json record of the tracking parameters
+    and the last completed frame, so that an interrupted analysis can resume where it stopped.
+    A checkpoint saved with different parameters is discarded.
+    """
+
+    def __init__(self, folder, params=None):
+
+        self.folder = folder
+        self.state_path = os.path.join(folder, 'checkpoint.json')
+        self.params = json.loads(json.dumps(params)) # TUPLES BECOME LISTS, AS THEY ARE WHEN LOADED
+        self.chunks = []
+        self.last_frame = None
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state['params'] == self.params:
+                self.chunks = state['chunks']
+                self.last_frame = state['last_frame']
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        # REMOVE CHUNKS FROM OTHER RUNS AND WRITES THAT WERE INTERRUPTED
+        for filename in os.listdir(folder):
+            if filename.startswith('chunk_') and filename not in self.chunks:
+                os.remove(os.path.join(folder, filename))
+
+    ############################
+
+    def load(self):
+        results = TrackingResults()
+        for filename in self.chunks:
+            results.extend(loadResults(os.path.join(self.folder, filename)))
+        return results
+
+    def save(self, results):
+        """Adds the results of newly completed frames to the checkpoint"""
+        if len(results) == 0:
+            return
+        filename = 'chunk_{:09d}.npz'.format(results.frames[0])
+        results.save(os.path.join(self.folder, filename))
+        self.chunks.append(filename)
+        self.last_frame = int(results.frames[len(results) - 1])
+        state = dict(params=self.params, chunks=self.chunks, last_frame=self.last_frame)
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+
+# RESULT CACHE #
+
+
+class ResultCache(object):
+    """
+    TrackingResults stored as .npz files named by a hash of the parameters of the analysis that produced them, with
+    the parameters alongside as json. Reading an entry marks it as used, and the least recently used entries are
+    evicted when the cache grows beyond max_bytes
+    """
+
+    def __init__(self, folder=None, max_bytes=2 * 1024 ** 3):
+
+        self.folder = folder if folder is not None else result_cache_folder
+        self.max_bytes = max_bytes
+
+    ############################
+
+    def key(self, params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def paramsPath(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+    def get(self, params):
+        path = self.path(self.key(params))
+        try:
+            results = loadResults(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(path)
+        return results
+
+    def put(self, params, results):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        key = self.key(params)
+        with open(self.paramsPath(key), 'w') as f:
+            json.dump(params, f)
+        results.save(self.path(key))
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of dicts with the key, parameters, size in bytes and last use time of each entry, most
+            recently used first
+        """
+        if not os.path.exists(self.folder):
+            return []
+        entries = []
+        for filename in os.listdir(self.folder):
+            if not filename.endswith('.npz'):
+                continue
+            key = filename[:-4]
+            try:
+                stat = os.stat(self.path(key))
+            except FileNotFoundError:
+                continue
+            try:
+                with open(self.paramsPath(key)) as f:
+                    params = json.load(f)
+            except (OSError, ValueError):
+                params = None
+            entries.append(dict(key=key, params=params, size=stat.st_size, last_used=stat.st_mtime))
+        entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+        return entries
+
+    def purge(self, keys=None):
+        '''removes the given entries (all entries if None)'''
+        if keys is None:
+            keys = [entry['key'] for entry in self.entries()]
+        for key in keys:
+            for path in (self.path(key), self.paramsPath(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        while entries and total > self.max_bytes:
+            entry = entries.pop()
+            self.purge([entry['key']])
+            total -= entry['size']
+
+
+# MANIFEST #
+
+
+class Manifest(object):
+    """
+    Record of the videos analysed into one output folder, saved there as json: the fingerprint of each video, the
+    parameters of its analysis, where its results were saved and whether the analysis finished. Videos whose record
+    is current can be skipped when the folder is analysed again, so only new, changed or failed videos are processed
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('WARNING: manifest {} is unreadable and will be rewritten'.format(path))
+
+    ############################
+
+    def key(self, filepath):
+        '''videos and outputs are recorded relative to the manifest, so that a whole session folder can be moved'''
+        filepath = os.path.abspath(filepath)
+        try:
+            return os.path.relpath(filepath, self.folder())
+        except ValueError:
+            # ON ANOTHER DRIVE THAN THE MANIFEST (WINDOWS)
+            return filepath
+
+    def folder(self):
+        return os.path.dirname(os.path.abspath(self.path))
+
+    def isCurrent(self, filepath, fingerprint, params, output_path):
+        '''True if the video was analysed successfully with the same parameters and its results still exist'''
+        entry = self.entries.get(self.key(filepath))
+        if entry is None or entry['status'] != 'done':
+            return False
+        return (entry['fingerprint'] == fingerprint and entry['params'] == json.loads(json.dumps(params)) and
+                os.path.normpath(os.path.join(self.folder(), entry['output'])) == os.path.abspath(output_path) and
+                os.path.exists(output_path))
+
+    def record(self, filepath, fingerprint, params, output_path, status='done', error=None):
+        self.entries[self.key(filepath)] = dict(fingerprint=fingerprint, params=params, output=self.key(output_path),
+                                                status=status, error=error, time=time.time())
+        self.save()
+
+    def save(self):
+        folder = self.folder()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# RESULT WRITERS #
+
+
+def float32Columns(df):
+    return df.astype({column: 'float32' for column in df.columns if df[column].dtype == 'float64'})
+
+
+def writeCSV(df, path):
+    df.to_csv(path)
+
+
+def writeParquet(df, path):
+    # NEEDS pyarrow (OR fastparquet)
+    float32Columns(df).to_parquet(path, compression='zstd')
+
+
+def writeFeather(df, path):
+    # NEEDS pyarrow. FEATHER FILES CANNOT STORE AN INDEX, SO IT IS SAVED AS A COLUMN
+    float32Columns(df).reset_index().to_feather(path, compression='zstd')
+
+
+def writeHDF5(df, path):
+    # NEEDS pytables. THE TABLE FORMAT IS STORED IN COMPRESSED CHUNKS
+    float32Columns(df).to_hdf(path, key='results', mode='w', format='table', complevel=5, complib='zlib')
+
+
+def writeNPZ(df, path):
+    columns = {column: values.to_numpy() for column, values in float32Columns(df).items()}
+    np.savez_compressed(path, index=df.index.to_numpy(), **columns)
+
+
+result_formats = {
+    'csv': ('.csv', writeCSV),
+    'parquet': ('.parquet', writeParquet),
+    'feather': ('.feather', writeFeather),
+    'hdf5': ('.h5', writeHDF5),
+    'npz': ('.npz', writeNPZ),
+}
+
+
+def resultFormat(path):
+    extension = os.path.splitext(path)[1].lower()
+    for fmt, (fmt_extension, writer) in result_formats.items():
+        if extension == fmt_extension or (fmt == 'hdf5' and extension == '.hdf5'):
+            return fmt
+    raise ValueError('unknown result format: {}'.format(extension))
+
+
+def writeResults(df, path, fmt=None):
+    """
+    Saves a results DataFrame. All formats except csv store float columns as float32 and are compressed
+    :param fmt: 'csv', 'parquet', 'feather', 'hdf5' or 'npz' (default: from the file extension)
+    """
+    if fmt is None:
+        fmt = resultFormat(path)
+    extension, writer = result_formats[fmt]
+    writer(df, path)
+
+
+def readResults(path, fmt=None):
+    if fmt is None:
+        fmt = resultFormat(path)
+    if fmt == 'csv':
+        return pd.read_csv(path, index_col=0)
+    elif fmt == 'parquet':
+        return pd.read_parquet(path)
+    elif fmt == 'feather':
+        df = pd.read_feather(path)
+        return df.set_index(df.columns[0])
+    elif fmt == 'hdf5':
+        return pd.read_hdf(path, key='results')
+    else:
+        with np.load(path) as data:
+            columns = [name for name in data.files if name != 'index']
+            return pd.DataFrame({name: data[name] for name in columns}, index=data['index'], columns=columns)
+
+
+# STREAMING SINKS #
+
+
+class ResultSink(object):
+    """
+    Appends blocks of results (DataFrames with the same columns) to a file as they are produced, so that memory use
+    does not grow with the length of the recording. Subclasses implement append
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.rows = 0
+
+    ############################
+
+    def write(self, df):
+        if len(df):
+            self.append(df)
+            self.rows += len(df)
+
+    def append(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CSVSink(ResultSink):
+    '''appends rows to a csv file, flushed after every block so the file can be read while it is being written'''
+
+    def __init__(self, path):
+
+        ResultSink.__init__(self, path)
+        self.file = open(path, 'w', newline='')
+
+    def append(self, df):
+        df.to_csv(self.file, header=self.rows == 0)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class HDF5Sink(ResultSink):
+    """
+    Appends to a compressed table in the same format as writeHDF5 (needs pytables), flushed to disk after every
+    block so that everything tracked so far is saved if the analysis is interrupted
+    """
+
+    def __init__(self, path):
+
+        ResultSink.__init__(self, path)
+        self.store = pd.HDFStore(path, mode='w', complevel=5, complib='zlib')
+
+    def append(self, df):
+        self.store.append('results', float32Columns(df), format='table')
+        self.store.flush(fsync=True)
+
+    def close(self):
+        self.store.close()
+
+
+class ParquetSink(ResultSink):
+    '''
+    writes each block as a parquet row group (needs pyarrow). The parquet footer is only written when the sink is
+    closed, so unlike the csv and hdf5 sinks the file cannot be read until then
+    '''
+
+    def __init__(self, path):
+
+        import pyarrow
+        import pyarrow.parquet
+        ResultSink.__init__(self, path)
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def append(self, df):
+        table = self.pyarrow.Table.from_pandas(float32Columns(df))
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema, compression='zstd')
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+result_sinks = {'csv': CSVSink, 'hdf5': HDF5Sink, 'parquet': ParquetSink}
+
+
+def openSink(path, fmt=None):
+    if fmt is None:
+        fmt = resultFormat(path)
+    if fmt not in result_sinks:
+        raise ValueError('results cannot be streamed to {} files'.format(fmt))
+    return result_sinks[fmt](path)
@@ -1,9 +1,17 @@
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
 enter_key = 13
 escape_key = 27
 monitor_size = (2560, 1440)
+background_cache_folder = '.background_cache'
 
 
 def cropImage(image, ROI):
@@ -12,6 +20,11 @@ def cropImage(image, ROI):
     cropped = image[y1:y2+1, x1:x2+1]
     return cropped
 
+def grayscale(image):
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
 def applyThreshold(image, value, threshold='to_zero'):
     if threshold == 'to_zero':
         ret, new = cv2.threshold(image, value, 255, cv2.THRESH_TOZERO)
@@ -33,15 +46,75 @@ def subtractBackground(image, background):
     return new
 
 
+@lru_cache(maxsize=None)
+def invertedThresholdLUT(thresh):
+    '''lookup table equivalent to inverting a uint8 image and applying a binary threshold'''
+    values = np.arange(256)
+    lut = np.where(255 - values > thresh, 255, 0).astype('uint8')
+    return lut
+
+
+def binariseImage(image, thresh, background=None, out=None):
+    """
+    Fused inversion (or background subtraction) and binary threshold: pixels that are more than thresh darker
+    than white (or than the background) become 255, all others 0. Multi-channel pixels pass if any channel does.
+    Single-channel input with a preallocated output does not allocate.
+    :param background: background image with the same shape as image (crop it with the same ROI)
+    :param out: uint8 output array with the image's height and width, reused between frames
+    :return: single-channel binary image
+    """
+    if out is None:
+        out = np.empty(image.shape[:2], dtype='uint8')
+    if background is None:
+        if image.ndim == 3:
+            image = np.amin(image, axis=2, out=out)
+        cv2.LUT(image, invertedThresholdLUT(thresh), dst=out)
+    else:
+        if image.ndim == 3:
+            np.amax(cv2.subtract(background, image), axis=2, out=out)
+        else:
+            cv2.subtract(background, image, dst=out)
+        cv2.threshold(out, thresh, 255, cv2.THRESH_BINARY, dst=out)
+    return out
+
+
 def findContours(image, offset=None):
 
-    new = cv2.cvtColor(np.copy(image), cv2.COLOR_RGB2GRAY)
+    new = grayscale(image)
     contours, hierarchy = cv2.findContours(new, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
     contours = sorted(contours, key=lambda contour: cv2.contourArea(contour))
     contours.reverse()
     return contours
 
 
+def videoFingerprint(filepath, blocks=16, block_size=4096, header_size=65536, frames=0):
+    """
+    Fast identity of a video file that does not read the whole file: hashes its size and modification time, the
+    container header and a fixed number of blocks spread evenly through the rest of the file
+    :param frames: also decode this many frames spread through the video and hash their pixels
+    :return: hex digest
+    """
+    stat = os.stat(filepath)
+    h = hashlib.sha1('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(filepath, 'rb') as f:
+        h.update(f.read(header_size))
+        span = max(0, stat.st_size - header_size - block_size)
+        if stat.st_size > header_size:
+            for i in range(blocks):
+                f.seek(header_size + span * i // max(1, blocks - 1))
+                h.update(f.read(block_size))
+    if frames:
+        capture = cv2.VideoCapture(filepath)
+        framecount = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        for n in sorted(set(np.linspace(0, max(0, framecount - 1), frames).astype(int))):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(n))
+            ret, frame = capture.read()
+            if ret:
+                h.update(np.ascontiguousarray(frame).tobytes())
+        capture.release()
+    return h.hexdigest()
+
+
 def drawContours(image, contours, c=0, t=1):
     new = np.copy(image)
     cv2.drawContours(new, contours, -1, c, t)
@@ -55,19 +128,24 @@ def equaliseHist(image):
 
 class Video(object):
 
-    def __init__(self, filepath, background=False):
+    def __init__(self, filepath, background=False, gray=False):
 
         self.name = filepath
+        self.filepath = filepath
         self.object = cv2.VideoCapture(filepath)
+        # decode straight to single-channel uint8 frames
+        self.gray = gray
         # self.framerate = self.object.get(cv2.CV_CAP_PROP_FPS)
         self.framecount = int(self.object.get(cv2.CAP_PROP_FRAME_COUNT))
         self.shape = (self.object.get(cv2.CAP_PROP_FRAME_WIDTH), self.object.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
         self.framenumber = 0
         self.limit_frames = [0, self.framecount]
+        # index of the last frame decoded by self.object, None if its position is unknown
+        self.last_read = -1
 
         if background:
-            self.background = self.intensityProjection()
+            self.background = self.computeBackground()
         else:
             self.background = None
 
@@ -76,11 +154,19 @@ class Video(object):
     ############################
 
     def grabFrame(self):
-        self.object.set(cv2.CAP_PROP_POS_FRAMES, self.framenumber)
+        # only seek if the capture is not already positioned at the requested frame
+        if self.last_read is None or self.framenumber != self.last_read + 1:
+            self.object.set(cv2.CAP_PROP_POS_FRAMES, self.framenumber)
         ret, frame = self.object.read()
-        # frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame = np.asarray(frame)
+        self.last_read = self.framenumber if ret else None
+        frame = self.convertFrame(frame)
+
+        return frame
 
+    def convertFrame(self, frame):
+        frame = np.asarray(frame)
+        if self.gray and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         return frame
 
     def updateFramenumber(self, n):
@@ -97,23 +183,133 @@ class Video(object):
 
         return frame
 
+    def iterFrames(self, start=None, stop=None, step=1):
+        """
+        Stream frames in order, seeking at most once
+        :param start: first frame (default 0)
+        :param stop: frame to stop before (default framecount)
+        :param step: yield every step-th frame, skipped frames are grabbed but not retrieved
+        :return: generator of (frame number, frame) tuples
+        """
+        if start is None:
+            start = 0
+        if stop is None:
+            stop = self.framecount
+        if self.last_read is None or start != self.last_read + 1:
+            self.object.set(cv2.CAP_PROP_POS_FRAMES, start)
+        self.last_read = start - 1
+        for n in range(start, stop, step):
+            while self.last_read + 1 < n:
+                if not self.object.grab():
+                    self.last_read = None
+                    return
+                self.last_read += 1
+            ret, frame = self.object.read()
+            if not ret:
+                self.last_read = None
+                return
+            self.last_read = n
+            self.framenumber = n
+            yield n, self.convertFrame(frame)
+
+    def prefetchFrames(self, start=None, stop=None, step=1, depth=8):
+        """
+        Stream frames like iterFrames while a background thread decodes ahead
+        :param depth: maximum number of decoded frames waiting in the queue
+        :return: FramePrefetcher (iterable of (frame number, frame) tuples)
+        """
+        return FramePrefetcher(self, start, stop, step, depth)
+
     ############################
 
-    def intensityProjection(self):
+    def intensityProjection(self, step=1, callback=None, method='max', percentile=50, workers=1):
+        """
+        Intensity projection of the video (maximum by default), computed in a single sequential pass or
+        split into one segment per worker process whose partial projections are then combined
+        :param step: only use every step-th frame
+        :param callback: called as callback(frame number, framecount) after each frame is added
+            (after each segment when using several workers)
+        :param method: 'max', 'min', 'mean' or 'percentile' (see Projection)
+        :param percentile: percentile used by the 'percentile' method
+        :param workers: number of worker processes (None uses all cores)
+        :return: background image
+        """
         print('calculating background...',)
-        background = self.grabFrameN(0)
-        for i in range(1, self.framecount):
-            img = self.grabFrameN(i)
-            brighter = np.transpose(np.where(img >= background))
-            for j, k in brighter:
-                background[j, k] = img[j, k]
+        if workers is None:
+            workers = os.cpu_count()
+        projection = Projection(method, percentile)
+        if workers > 1:
+            segments = splitFrameRange(0, self.framecount, workers, step)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(segmentProjection, self.filepath, start, stop, step, method, percentile,
+                                           self.gray) for start, stop in segments]
+                if callback is not None:
+                    for future in as_completed(futures):
+                        callback(segments[futures.index(future)][1] - 1, self.framecount)
+                for future in futures:
+                    projection.combine(future.result())
+        else:
+            for n, img in self.iterFrames(0, self.framecount, step):
+                projection.add(img)
+                if callback is not None:
+                    callback(n, self.framecount)
         self.updateFramenumber(0)
         print('complete!')
+        return projection.result()
+
+
+    def computeBackground(self, step=1, method='max', percentile=50, workers=1, callback=None, cache=True,
+                          cache_dir=None):
+        """
+        intensityProjection, loaded from the on-disk background cache when this exact file has already been
+        projected with the same parameters
+        :param cache: look up and store the result in the cache
+        :param cache_dir: cache directory (default: a .background_cache folder next to the video)
+        :return: background image
+        """
+        if not cache:
+            return self.intensityProjection(step, callback, method, percentile, workers)
+        cache_path = self.backgroundCachePath(step, method, percentile, cache_dir)
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+        background = self.intensityProjection(step, callback, method, percentile, workers)
+        if background is not None:
+            try:
+                self.storeBackground(background, cache_path)
+            except OSError as e:
+                print('WARNING: could not cache background ({})'.format(e))
         return background
 
+    def backgroundCachePath(self, step=1, method='max', percentile=50, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(self.filepath)), background_cache_folder)
+        if method == 'percentile':
+            method += str(percentile)
+        params = '{}_step{}_{}'.format(method, step, 'gray' if self.gray else 'bgr')
+        filename = '{}_{}_{}.npy'.format(os.path.basename(self.filepath), params, self.fingerprint()[:16])
+        return os.path.join(cache_dir, filename)
+
+    def storeBackground(self, background, cache_path):
+        cache_dir, filename = os.path.split(cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # REMOVE BACKGROUNDS CACHED FOR PREVIOUS VERSIONS OF THE FILE
+        stale_prefix = filename.rsplit('_', 1)[0] + '_'
+        for f in os.listdir(cache_dir):
+            if f.startswith(stale_prefix) and f != filename and len(f) == len(filename):
+                os.remove(os.path.join(cache_dir, f))
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.save(f, background)
+        os.replace(cache_path + '.tmp', cache_path)
+
+    def fingerprint(self, frames=0):
+        '''fast identity of the video file (see videoFingerprint), used as the key of cached backgrounds and results'''
+        return videoFingerprint(self.filepath, frames=frames)
 
     def importBackground(self, tiff_filepath):
         background = cv2.imread(tiff_filepath, 0)
+        if not self.gray:
+            background = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
         self.background = background
 
     ############################
@@ -205,6 +401,153 @@ class Video(object):
         self.updateFramenumber(self.framenumber)
 
 
+class FramePrefetcher(object):
+    """
+    Decodes frames of a Video on a background thread into a bounded queue.
+    OpenCV releases the GIL while decoding, so decoding overlaps with analysis of the frames already
+    in the queue. Frames are handed over without copying: each array belongs to the consumer once yielded.
+    The video must not be read from elsewhere until the prefetcher is exhausted or closed.
+    """
+
+    _end = object()
+
+    def __init__(self, video, start=None, stop=None, step=1, depth=8):
+
+        self.video = video
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stopped = threading.Event()
+        self.error = None
+
+        self.thread = threading.Thread(target=self._decode, args=(start, stop, step))
+        self.thread.daemon = True
+        self.thread.start()
+
+    ############################
+
+    def _decode(self, start, stop, step):
+        try:
+            for item in self.video.iterFrames(start, stop, step):
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self.error = e
+        self._put(self._end)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._end:
+                    break
+                yield item
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# BACKGROUND PROJECTIONS #
+
+
+class Projection(object):
+    """
+    Per-pixel projection of a stack of frames that can be built in pieces and combined.
+    'max' and 'min' keep a running extreme, 'mean' keeps a float64 running sum (exact for uint8 frames) and
+    'percentile' keeps every frame it is given, so use a frame stride to bound its memory.
+    Combining partial projections gives the same result as adding every frame to a single projection.
+    """
+
+    methods = ('max', 'min', 'mean', 'percentile')
+
+    def __init__(self, method='max', percentile=50):
+
+        if method not in self.methods:
+            raise ValueError('invalid projection method')
+        self.method = method
+        self.percentile = percentile
+        self.data = None
+        self.count = 0
+
+    ############################
+
+    def add(self, frame):
+        if self.method == 'percentile':
+            if self.data is None:
+                self.data = []
+            self.data.append(frame)
+        elif self.data is None:
+            self.data = frame.astype('f8') if self.method == 'mean' else frame
+        elif self.method == 'max':
+            np.maximum(self.data, frame, out=self.data)
+        elif self.method == 'min':
+            np.minimum(self.data, frame, out=self.data)
+        else:
+            self.data += frame
+        self.count += 1
+
+    def combine(self, other):
+        if other.data is None:
+            return
+        if self.data is None:
+            self.data = other.data
+        elif self.method == 'percentile':
+            self.data = self.data + other.data
+        elif self.method == 'max':
+            np.maximum(self.data, other.data, out=self.data)
+        elif self.method == 'min':
+            np.minimum(self.data, other.data, out=self.data)
+        else:
+            self.data += other.data
+        self.count += other.count
+
+    def result(self):
+        if self.data is None:
+            return None
+        if self.method == 'mean':
+            return np.round(self.data / self.count).astype('uint8')
+        elif self.method == 'percentile':
+            projected = np.percentile(np.stack(self.data), self.percentile, axis=0)
+            return np.round(projected).astype('uint8')
+        return self.data
+
+
+def splitFrameRange(start, stop, chunks, step=1):
+    """Splits the frames range(start, stop, step) into at most n contiguous (start, stop) segments"""
+    n = len(range(start, stop, step))
+    chunks = max(1, min(chunks, n))
+    bounds = [start + step * ((n * i) // chunks) for i in range(chunks)] + [stop]
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def segmentProjection(filepath, start, stop, step=1, method='max', percentile=50, gray=False):
+    """Partial projection of one segment of a video, opened separately so it can run in a worker process"""
+    video = Video(filepath, gray=gray)
+    projection = Projection(method, percentile)
+    for n, img in video.iterFrames(start, stop, step):
+        projection.add(img)
+    video.object.release()
+    return projection
+
+
 ####################################################################################
 
 